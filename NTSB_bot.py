@@ -3,7 +3,11 @@
 
 """Post all new NTSB aviation accident database entries to a subreddit"""
 
+import io
+import os
 import csv
+import html
+import time
 import praw
 import logging
 import configparser
@@ -12,6 +16,8 @@ import avdata
 import mdb_reader
 
 from pathlib import Path
+from queue import Queue
+from threading import Thread
 from datetime import datetime, date
 from colorama import init, Fore, Back, Style
 from logging.handlers import RotatingFileHandler
@@ -22,31 +28,287 @@ DRY_RUN = True # No submissions will be made if true
 EPOCH = date.fromisoformat("2022-04-01") # YYYY-MM-DD
 ID_DATABASE_FILEPATH = Path("Aviation_Data/id_database.csv")
 ACCOUNT_INFO_FILEPATH = Path("account.ini")
+MAX_PENDING_SUBMISSIONS = 100 # Per target, bounds how far rendering can run ahead of submitting
+JOURNAL_BATCH_SIZE = 10 # Submissions per journal commit
+RECOVERY_CLOCK_SKEW = 300 # Seconds before the oldest intent that posts are searched back to, in case of clock skew
 
-def load_id_database() -> list[str]:
-    ID_DATABASE_FILEPATH.touch() # Create the ID database if it doesn't exist
-    with open(ID_DATABASE_FILEPATH, 'r') as csv_fp:
+def load_id_database(id_database_filepath: Path) -> list[str]:
+    id_database_filepath.touch() # Create the ID database if it doesn't exist
+    with open(id_database_filepath, 'r') as csv_fp:
         data = list(csv.reader(csv_fp))
         return data[0] if data else []
 
-def save_id_database(id_database: list[str]):
-    with open(ID_DATABASE_FILEPATH, 'w') as csv_fp:
+def save_id_database(id_database_filepath: Path, id_database: list[str]):
+    """Atomically replace the ID database, so a crash leaves either the old or new copy."""
+    temp_filepath = id_database_filepath.with_suffix(".tmp")
+    with open(temp_filepath, 'w') as csv_fp:
         csv.writer(csv_fp).writerow(id_database)
+        csv_fp.flush()
+        os.fsync(csv_fp.fileno())
+    os.replace(temp_filepath, id_database_filepath)
 
-def get_subreddit() -> praw.models.Subreddit | None:
+class SubmissionJournal:
+    """
+    Represents a write-ahead log of submissions. Each event is journaled as
+    an intent before submitting, then a result (the Reddit post ID). An
+    event is complete once the ID database is atomically saved with it, at
+    which point the journal is emptied, so completion isn't journaled.
+    Entries are buffered and only made durable by commit, so a batch of
+    entries shares one fsync.
+
+    Attributes
+    ----------
+    journal_filepath : Path
+        the location of the journal
+    """
+    def __init__(self, journal_filepath: Path) -> None:
+        self.journal_filepath = journal_filepath
+        self.journal_fp = open(journal_filepath, 'a', newline='')
+        self.writer = csv.writer(self.journal_fp)
+
+    def read(self) -> dict[str, dict]:
+        """Replay the journal, returning the entries recorded for each event ID."""
+        entries = {}
+        with open(self.journal_filepath, 'r', newline='', errors="replace") as csv_fp:
+            text = csv_fp.read().replace('\0', '') # A crash can leave a NUL-filled tail
+        try:
+            for row in csv.reader(io.StringIO(text, newline='')):
+                try:
+                    if len(row) == 5 and row[0] == "intent":
+                        entries.setdefault(row[1], {}).update(title=row[2], ntsb_no=row[3], time=float(row[4]))
+                    elif len(row) == 3 and row[0] == "result":
+                        entries.setdefault(row[1], {})["post_id"] = row[2]
+                except ValueError:
+                    pass # A torn write from a crash, like any other malformed row
+        except csv.Error:
+            logging.exception(f"Journal Exception ({self.journal_filepath}), ignoring the rest")
+        return entries
+
+    def append(self, *entry: str | float):
+        self.writer.writerow(entry)
+
+    def commit(self):
+        self.journal_fp.flush()
+        os.fsync(self.journal_fp.fileno())
+
+    def truncate(self):
+        self.journal_fp.truncate(0)
+        self.commit()
+
+    def close(self):
+        self.journal_fp.close()
+
+def get_intent(document: mdb_reader.Report, intent_time: float) -> dict:
+    """Describe a submission the way the journal records its intent."""
+    ntsb_no = document.ntsb_no if document.ntsb_no not in ["NONE", "None", None] else ''
+    return {"title": document.title, "ntsb_no": ntsb_no, "time": intent_time}
+
+class Target:
+    """
+    Represents a subreddit that reports are fanned out to. Submissions run on
+    the target's own worker thread, so targets are submitted to concurrently.
+
+    Attributes
+    ----------
+    name : str
+        the name of the target's section in the account info
+    reddit : praw.Reddit
+        the target's own Reddit instance
+    subreddit : praw.models.Subreddit
+        the subreddit to submit to
+    condition : str | None
+        an SQL condition on the events table that reports must satisfy
+    id_database_filepath : Path
+        stores the IDs already submitted to this target
+    journal : SubmissionJournal | None
+        records submissions since the ID database was last saved, if not a dry run
+    submit_interval : float
+        the minimum number of seconds between submissions
+    queued : int
+        the number of reports handed to the worker
+    succeeded, failed, skipped : int
+        the submission metrics
+    """
+    def __init__(self, name: str, reddit: praw.Reddit, subreddit_name: str, condition: str | None, id_database_filepath: Path, submit_interval: float) -> None:
+        self.name = name
+        self.reddit = reddit
+        self.subreddit = reddit.subreddit(subreddit_name)
+        self.condition = condition
+        self.id_database_filepath = id_database_filepath
+        self.submit_interval = submit_interval
+        self.id_database = load_id_database(id_database_filepath)
+        self.journal = None
+        if not DRY_RUN:
+            self.journal = SubmissionJournal(id_database_filepath.with_suffix(".journal"))
+            self.recover()
+        self.seen_ids = set(self.id_database) # Also holds queued IDs, so events listed in several mdb files are posted once
+        self.queued = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.last_submit_time = 0.0
+        self.queue = Queue(maxsize=MAX_PENDING_SUBMISSIONS)
+        self.worker = Thread(target=self.run, name=name, daemon=True)
+        self.worker.start()
+
+    def find_posts(self, intents: dict[str, dict]) -> dict[str, str]:
+        """Search the account's posts in this subreddit for journaled intents,
+        newest first and back to the oldest intent. Returns the post ID found
+        for each event ID. Reddit escapes titles, so they're unescaped, and
+        the NTSB number in the signature tells apart events with equal titles."""
+        oldest_time = min(intent["time"] for intent in intents.values()) - RECOVERY_CLOCK_SKEW
+        found = {}
+        for submission in self.reddit.user.me().submissions.new(limit=None):
+            if submission.created_utc < oldest_time or len(found) == len(intents):
+                break
+            if submission.subreddit.display_name.lower() != self.subreddit.display_name.lower():
+                continue
+            title = html.unescape(submission.title).strip()
+            selftext = html.unescape(submission.selftext)
+            for event_id, intent in intents.items():
+                if event_id not in found and title == intent["title"].strip() and f"**{intent['ntsb_no'] or 'No data'}**" in selftext:
+                    found[event_id] = submission.id
+                    break
+        return found
+
+    def recover(self):
+        """Reconcile incomplete journal entries left by a crash or failed
+        submission, then checkpoint. Intents without a result are looked for
+        among the account's posts rather than being submitted again."""
+        entries = self.journal.read()
+        unresolved = {event_id: entry for event_id, entry in entries.items() if "post_id" not in entry}
+        intents = {event_id: entry for event_id, entry in unresolved.items() if "title" in entry}
+        found = self.find_posts(intents) if intents else {}
+        for event_id in entries:
+            if event_id in unresolved:
+                if event_id not in found:
+                    logging.info(f"Recovered {event_id} ({self.name}): never submitted")
+                    continue
+                logging.info(f"Recovered {event_id} ({self.name}): found post {found[event_id]}")
+            if event_id not in self.id_database:
+                self.id_database.append(event_id)
+        self.checkpoint()
+
+    def checkpoint(self):
+        """Save the ID database, then empty the journal it now covers."""
+        save_id_database(self.id_database_filepath, self.id_database)
+        self.journal.truncate()
+
+    def enqueue(self, document: mdb_reader.Report):
+        """Hand a report to the worker, blocking while too many are pending."""
+        if document.event_id in self.seen_ids:
+            self.skipped += 1
+            return
+        self.seen_ids.add(document.event_id)
+        self.queued += 1
+        self.queue.put(document)
+
+    def run(self):
+        """Submit queued reports in batches until None is queued."""
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < JOURNAL_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get())
+            if None in batch:
+                stopping = True
+                batch.remove(None)
+            self.submit_batch(batch)
+
+    def submit_batch(self, documents: list[mdb_reader.Report]):
+        intent_time = time.time()
+        if not DRY_RUN:
+            try:
+                for document in documents:
+                    intent = get_intent(document, intent_time)
+                    self.journal.append("intent", document.event_id, intent["title"], intent["ntsb_no"], intent["time"])
+                self.journal.commit() # Intents must be durable before anything is posted
+            except Exception: # Don't catch KeyboardInterrupt
+                logging.exception(f"Journal Exception ({self.name})")
+                self.failed += len(documents)
+                return
+        for document in documents:
+            try:
+                if not DRY_RUN:
+                    self.journal.append("result", document.event_id, self.submit(document, intent_time))
+                self.id_database.append(document.event_id)
+                self.succeeded += 1
+            except Exception: # Don't catch KeyboardInterrupt
+                logging.exception(f"Submission Exception ({self.name})")
+                self.failed += 1
+        if not DRY_RUN:
+            try:
+                self.journal.commit() # Results that aren't durable are reconciled by recover
+            except Exception: # Don't catch KeyboardInterrupt
+                logging.exception(f"Journal Exception ({self.name})")
+
+    def submit(self, document: mdb_reader.Report, intent_time: float) -> str:
+        """Submit a report, returning its post ID. A failed submission may
+        still have been posted (e.g. on a timeout), so the post is looked for
+        while it's among the newest, before giving up."""
+        time.sleep(max(0.0, self.last_submit_time + self.submit_interval - time.monotonic()))
+        self.last_submit_time = time.monotonic()
+        try:
+            return self.subreddit.submit(title=document.title, selftext=document.text).id
+        except Exception:
+            intents = {document.event_id: get_intent(document, intent_time)}
+            if (post_id := self.find_posts(intents).get(document.event_id)) is None:
+                raise
+            logging.warning(f"Submission Exception ({self.name}), but found post {post_id} for {document.event_id}", exc_info=True)
+            return post_id
+
+    def is_idle(self) -> bool:
+        return self.succeeded + self.failed == self.queued or not self.worker.is_alive()
+
+    def close(self):
+        """Stop the worker once the queue is drained, then reconcile any
+        failed submissions and checkpoint. If that fails, the journal is
+        kept for the next startup to reconcile."""
+        self.queue.put(None)
+        self.worker.join()
+        if not DRY_RUN:
+            try:
+                try:
+                    self.recover()
+                finally:
+                    self.journal.close()
+            except Exception: # Don't catch KeyboardInterrupt
+                logging.exception(f"Recovery Exception ({self.name})")
+
+def get_targets() -> list[Target] | None:
     config = configparser.ConfigParser(allow_no_value=True)
     try:
         config.read(ACCOUNT_INFO_FILEPATH)
-        reddit = praw.Reddit(
-            client_id=config["ACCOUNT INFO"]["client id"],
-            client_secret=config["ACCOUNT INFO"]["client secret"],
-            password=config["ACCOUNT INFO"]["password"],
-            user_agent=config["ACCOUNT INFO"]["user agent"],
-            username=config["ACCOUNT INFO"]["username"],
-        )
-        reddit.validate_on_submit = True
+        target_sections = [section for section in config.sections() if section.startswith("TARGET ")]
+        if not target_sections: # Fall back to the single subreddit in the account info
+            config["TARGET default"] = {
+                "subreddit name": config["ACCOUNT INFO"]["subreddit name"],
+                "id database": str(ID_DATABASE_FILEPATH),
+            }
+            target_sections = ["TARGET default"]
+
+        targets = []
+        for section in target_sections:
+            name = section.removeprefix("TARGET ").strip()
+            reddit = praw.Reddit( # One instance per target, since praw isn't thread safe
+                client_id=config["ACCOUNT INFO"]["client id"],
+                client_secret=config["ACCOUNT INFO"]["client secret"],
+                password=config["ACCOUNT INFO"]["password"],
+                user_agent=config["ACCOUNT INFO"]["user agent"],
+                username=config["ACCOUNT INFO"]["username"],
+            )
+            reddit.validate_on_submit = True
+            default_id_database = ID_DATABASE_FILEPATH.with_stem(f"{ID_DATABASE_FILEPATH.stem}_{name}")
+            targets.append(Target(
+                name,
+                reddit,
+                config[section]["subreddit name"],
+                config[section].get("filter") or None,
+                Path(config[section].get("id database") or default_id_database),
+                config[section].getfloat("submit interval", fallback=0.0),
+            ))
         print(f'Logged in as {Style.BRIGHT + Fore.GREEN + config["ACCOUNT INFO"]["username"]}')
-        return reddit.subreddit(config["ACCOUNT INFO"]["subreddit name"])
+        return targets
     except Exception: # Don't catch KeyboardInterrupt
         logging.exception("Login Exception")
         return None
@@ -57,35 +319,40 @@ def get_upload_bar(current_value: int, total_value: int) -> str:
     bar_completed = "\N{full block}" * int(bar_length * percentage)
     return f"\r   {percentage:>4.0%} |{bar_completed:<{bar_length}}| {current_value}/{total_value}"
 
-def submit_new_documents(subreddit: praw.models.Subreddit, relevant_mdb_filepaths: Path):
-    id_database = load_id_database()
-    total_succeeded = 0
+def get_targets_str(targets: list[Target]) -> str:
+    return " - " + ", ".join(f"{target.name} {target.succeeded}/{target.queued}" for target in targets)
+
+def get_errors_str(targets: list[Target]) -> str:
+    failed = sum(target.failed for target in targets)
+    return " - " + (Style.BRIGHT + Fore.RED + f"ERR {failed}") if failed > 0 else ''
+
+def submit_new_documents(targets: list[Target], relevant_mdb_filepaths: Path):
+    conditions = {target.name: target.condition for target in targets}
+    seen_ids = {target.name: target.seen_ids for target in targets} # Updated as reports are enqueued
     for relevant_mdb_filepath in relevant_mdb_filepaths:
-        failed = 0
-        succeeded = 0
-        skipped = 0
-        errors_str= ''
-        doc_generator = mdb_reader.parse_events(EPOCH, relevant_mdb_filepath)
+        rendered = 0
+        doc_generator = mdb_reader.parse_events(EPOCH, relevant_mdb_filepath, conditions, seen_ids)
         documents_len = next(doc_generator)
-        print(f"\nSubmitting {Style.BRIGHT + Fore.GREEN + relevant_mdb_filepath.name}:")
+        print(f"\nRendering {Style.BRIGHT + Fore.GREEN + relevant_mdb_filepath.name}:")
         print(get_upload_bar(0, documents_len), end = '\r')
-        for document in doc_generator:
-            if document.event_id not in id_database: # TODO: Move filtering into mdb_reader module
-                try:
-                    if not DRY_RUN: subreddit.submit(title=document.title, selftext=document.text)
-                    id_database.append(document.event_id)
-                    if not DRY_RUN: save_id_database(id_database)
-                    succeeded += 1
-                except Exception: # Don't catch KeyboardInterrupt
-                    logging.exception("Submission Exception")
-                    failed += 1
-                    errors_str = " - " + (Style.BRIGHT + Fore.RED + f"ERR {failed}")
-            else:
-                skipped += 1
-            print(get_upload_bar(succeeded + failed + skipped, documents_len) + errors_str, end = '\r')
+        for document in doc_generator: # Render each report once, then fan it out to every matching target
+            if document is not None:
+                for target in targets:
+                    if target.name in document.targets:
+                        target.enqueue(document)
+            rendered += 1
+            print(get_upload_bar(rendered, documents_len) + get_targets_str(targets) + get_errors_str(targets), end = '\r')
         print()
-        total_succeeded += succeeded
-    print(f"\nScan complete: Added {total_succeeded} incidents!")
+
+    for target in targets:
+        print(f"\nSubmitting to {Style.BRIGHT + Fore.GREEN + target.name} (r/{target.subreddit.display_name}):")
+        while not target.is_idle():
+            print(get_upload_bar(target.succeeded + target.failed, target.queued) + get_errors_str([target]), end = '\r')
+            time.sleep(0.1)
+        target.close()
+        print(get_upload_bar(target.succeeded + target.failed, target.queued) + get_errors_str([target]))
+        print(f"   Added {target.succeeded}, failed {target.failed}, skipped {target.skipped}")
+    print(f"\nScan complete: Added {sum(target.succeeded for target in targets)} posts!")
 
 def update_sidebar_date(subreddit: praw.models.Subreddit):
     print("Updating sidebar: ", end='')
@@ -109,6 +376,9 @@ logging.basicConfig(level=logging.NOTSET)
 if __name__ == "__main__":
     logging.info("Program started.")
     relevant_mdb_filepaths = avdata.update()
-    if (subreddit := get_subreddit()) is not None:
-        submit_new_documents(subreddit, relevant_mdb_filepaths)
-        if not DRY_RUN: update_sidebar_date(subreddit)
+    if (targets := get_targets()) is not None:
+        submit_new_documents(targets, relevant_mdb_filepaths)
+        if not DRY_RUN:
+            subreddits = {target.subreddit.display_name.lower(): target.subreddit for target in targets}
+            for subreddit in subreddits.values():
+                update_sidebar_date(subreddit)
@@ -396,6 +396,8 @@ class Report:
         the submission title
     text : str
         the submission body
+    targets : set[str]
+        the names of the filter conditions this event satisfies
     """
     def __init__(self, event_id: str, ntsb_no: str) -> None:
         self.date = event_id[:8]
@@ -403,11 +405,31 @@ class Report:
         self.ntsb_no = ntsb_no
         self.title = ''
         self.text = ''
+        self.targets = set()
 
-def parse_events(epoch: date, mdb_filepath: Path) -> Iterator[int | Report]:
-    """Generate the aircraft and owner/operator information table.
+def select_events(epoch: date, condition: str) -> set[str]:
+    """Fetch the IDs of all events since epoch that satisfy an SQL condition
+    on the events table."""
+
+    cursor.execute(f"""
+        SELECT
+            ev_id
+        FROM
+            events
+        WHERE
+            lchg_date >= #{epoch.strftime("%m/%d/%Y")}# and
+            ({condition})
+        ;
+        """)
+    return {row.ev_id for row in cursor.fetchall()}
+
+def parse_events(epoch: date, mdb_filepath: Path, conditions: dict[str, str | None] | None = None, seen_ids: dict[str, set[str]] | None = None) -> Iterator[int | Report | None]:
+    """Generate the formatted reports for all events since epoch.
     The first element returned is the amount of reports available.
-    The remaining elements returned are the reports."""
+    The remaining elements returned are the reports. Each report is rendered
+    once, and its targets are the names of the conditions it satisfies.
+    If conditions are given, reports are only rendered if a matching target
+    hasn't seen their event ID yet, and None is returned in place of the rest."""
     global cursor
 
     # connect to db
@@ -426,10 +448,20 @@ def parse_events(epoch: date, mdb_filepath: Path) -> Iterator[int | Report]:
         ;
         """)
     relevant_events = cursor.fetchall()
+    all_events = {row.ev_id for row in relevant_events}
+    matching_events = {
+        name: all_events if condition is None else select_events(epoch, condition)
+        for name, condition in (conditions or {}).items()
+    }
+    seen_ids = seen_ids or {}
     yield len(relevant_events)
     for row in relevant_events:
         if row.ev_id not in ["NONE", "None", None]:
             report = Report(row.ev_id, row.ntsb_no)
+            report.targets = {name for name, ev_ids in matching_events.items() if row.ev_id in ev_ids}
+            if conditions is not None and all(report.event_id in seen_ids.get(name, ()) for name in report.targets):
+                yield None # Nothing left to submit, so skip rendering
+                continue
 
             report.title = generate_title(row.ev_id)
             report.title = ''.join(filter(lambda x: x in set(string.printable), report.title))
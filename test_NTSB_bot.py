@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for fanning out reports to targets, and fault injection tests for the
+submission journal, against a local stand-in for Reddit"""
+
+import html
+import time
+import pytest
+
+import NTSB_bot
+import mdb_reader
+
+from pathlib import Path
+from datetime import date
+from types import SimpleNamespace
+
+class Crash(BaseException):
+    """Simulates the process dying. Like KeyboardInterrupt, it isn't caught as an Exception."""
+
+class FakeSubreddit:
+    def __init__(self, reddit: "FakeReddit", display_name: str) -> None:
+        self.reddit = reddit
+        self.display_name = display_name
+
+    def submit(self, title: str, selftext: str) -> SimpleNamespace:
+        fault = self.reddit.faults.get(self.reddit.submit_calls)
+        self.reddit.submit_calls += 1
+        if fault == "crash before post": raise Crash
+        if fault == "error before post": raise ConnectionError
+        submission = SimpleNamespace(
+            id=f"p{len(self.reddit.posts)}",
+            title=html.escape(title.strip(), quote=False), # Reddit escapes &, < and > in titles
+            selftext=selftext,
+            subreddit=self,
+            created_utc=time.time(),
+        )
+        self.reddit.posts.insert(0, submission)
+        if fault == "crash after post": raise Crash
+        if fault == "timeout after post": raise TimeoutError
+        return submission
+
+class FakeReddit:
+    """Records posts newest first, and injects faults by submission number."""
+    def __init__(self, faults: dict[int, str] | None = None) -> None:
+        self.posts = []
+        self.faults = faults or {}
+        self.submit_calls = 0
+        self.search_fails = False
+        self.user = SimpleNamespace(me=self.me)
+
+    def me(self) -> SimpleNamespace:
+        if self.search_fails: raise ConnectionError
+        return SimpleNamespace(submissions=SimpleNamespace(new=self.new))
+
+    def subreddit(self, display_name: str) -> FakeSubreddit:
+        return FakeSubreddit(self, display_name)
+
+    def new(self, limit: int | None):
+        return iter(self.posts[:limit])
+
+@pytest.fixture
+def committed_sizes(monkeypatch) -> dict:
+    """Submit for real, and track how much of each journal is durable."""
+    monkeypatch.setattr(NTSB_bot, "DRY_RUN", False)
+    sizes = {}
+    commit = NTSB_bot.SubmissionJournal.commit
+    def tracked_commit(journal):
+        commit(journal)
+        sizes[journal.journal_filepath] = journal.journal_filepath.stat().st_size
+    monkeypatch.setattr(NTSB_bot.SubmissionJournal, "commit", tracked_commit)
+    return sizes
+
+def crash(target: NTSB_bot.Target, committed_sizes: dict):
+    """Discard everything the target journaled but didn't commit."""
+    journal_filepath = target.journal.journal_filepath
+    target.journal.close()
+    with open(journal_filepath, "r+") as fp:
+        fp.truncate(committed_sizes.get(journal_filepath, 0))
+
+def make_reports(count: int) -> list[mdb_reader.Report]:
+    """Pairs of reports share a title, and only differ by NTSB number."""
+    reports = []
+    for i in range(count):
+        report = mdb_reader.Report(f"20220401E{i}", f"ERA22LA{i:03}")
+        report.title = f"[1 Fatal] [April 01 2022] Piper & Cessna {i // 2}, City/ ST United States "
+        report.text = f"Narrative {i // 2}\n\nsearch with the NTSB Number **{report.ntsb_no}**\n"
+        reports.append(report)
+    return reports
+
+def resume(reddit: FakeReddit, id_database_filepath, reports: list[mdb_reader.Report]) -> NTSB_bot.Target:
+    """Start a new run, submitting every report not already submitted."""
+    target = NTSB_bot.Target("test", reddit, "sub", None, id_database_filepath, 0)
+    for report in reports:
+        target.enqueue(report)
+    target.close()
+    return target
+
+def assert_posted_once(reddit: FakeReddit, id_database_filepath, reports: list[mdb_reader.Report]):
+    assert sorted(post.selftext for post in reddit.posts) == sorted(report.text for report in reports)
+    assert sorted(NTSB_bot.load_id_database(id_database_filepath)) == sorted(report.event_id for report in reports)
+    assert id_database_filepath.with_suffix(".journal").stat().st_size == 0
+
+@pytest.mark.parametrize("fault", ["crash before post", "crash after post"])
+@pytest.mark.parametrize("fault_at", range(5))
+def test_crash_during_submission(tmp_path, committed_sizes, fault, fault_at):
+    id_database_filepath = tmp_path / "id_database.csv"
+    reddit = FakeReddit({fault_at: fault})
+    reports = make_reports(5)
+    target = NTSB_bot.Target("test", reddit, "sub", None, id_database_filepath, 0)
+    with pytest.raises(Crash):
+        target.submit_batch(reports)
+    crash(target, committed_sizes)
+
+    resume(reddit, id_database_filepath, reports)
+    assert_posted_once(reddit, id_database_filepath, reports)
+
+def test_crash_loses_journal_buffer(tmp_path, committed_sizes):
+    id_database_filepath = tmp_path / "id_database.csv"
+    reddit = FakeReddit()
+    reports = make_reports(5)
+    target = NTSB_bot.Target("test", reddit, "sub", None, id_database_filepath, 0)
+    commit = target.journal.commit
+    commits = []
+    def crashing_commit():
+        commits.append(None)
+        if len(commits) == 2: raise Crash # Every post was made, but no result is durable
+        commit()
+    target.journal.commit = crashing_commit
+    with pytest.raises(Crash):
+        target.submit_batch(reports)
+    crash(target, committed_sizes)
+    assert len(reddit.posts) == 5
+
+    resume(reddit, id_database_filepath, reports)
+    assert_posted_once(reddit, id_database_filepath, reports)
+
+def test_crash_between_save_and_truncate(tmp_path, committed_sizes):
+    id_database_filepath = tmp_path / "id_database.csv"
+    reddit = FakeReddit()
+    reports = make_reports(5)
+    target = NTSB_bot.Target("test", reddit, "sub", None, id_database_filepath, 0)
+    def crashing_truncate():
+        raise Crash
+    target.journal.truncate = crashing_truncate
+    for report in reports:
+        target.enqueue(report)
+    with pytest.raises(Crash):
+        target.close()
+    crash(target, committed_sizes)
+
+    resume(reddit, id_database_filepath, reports)
+    assert_posted_once(reddit, id_database_filepath, reports)
+
+def test_timeout_that_still_posted(tmp_path, committed_sizes):
+    id_database_filepath = tmp_path / "id_database.csv"
+    reddit = FakeReddit({0: "timeout after post"})
+    reports = make_reports(150) # Enough later posts to push the first out of a short search
+    target = resume(reddit, id_database_filepath, reports)
+    assert (target.succeeded, target.failed) == (150, 0)
+    assert_posted_once(reddit, id_database_filepath, reports)
+
+def test_error_that_never_posted(tmp_path, committed_sizes):
+    id_database_filepath = tmp_path / "id_database.csv"
+    reddit = FakeReddit({2: "error before post"})
+    reports = make_reports(5)
+    target = resume(reddit, id_database_filepath, reports)
+    assert (target.succeeded, target.failed) == (4, 1)
+    assert reports[2].event_id not in NTSB_bot.load_id_database(id_database_filepath)
+
+    resume(reddit, id_database_filepath, reports)
+    assert_posted_once(reddit, id_database_filepath, reports)
+
+def test_journal_failure_fails_batch(tmp_path, committed_sizes):
+    id_database_filepath = tmp_path / "id_database.csv"
+    reddit = FakeReddit()
+    reports = make_reports(5)
+    target = NTSB_bot.Target("test", reddit, "sub", None, id_database_filepath, 0)
+    def failing_commit():
+        raise OSError("No space left on device")
+    target.journal.commit = failing_commit
+    for report in reports:
+        target.enqueue(report)
+    deadline = time.monotonic() + 5
+    while not target.is_idle() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert target.is_idle() and target.worker.is_alive()
+    assert (target.succeeded, target.failed) == (0, 5)
+    assert reddit.posts == [] # Nothing is posted without a durable intent
+
+    target.close() # Checkpointing fails too, which is logged rather than raised
+    resume(reddit, id_database_filepath, reports)
+    assert_posted_once(reddit, id_database_filepath, reports)
+
+def test_reconcile_failure_keeps_journal(tmp_path, committed_sizes):
+    id_database_filepath = tmp_path / "id_database.csv"
+    reddit = FakeReddit({2: "error before post"})
+    reddit.search_fails = True
+    reports = make_reports(5)
+    target = resume(reddit, id_database_filepath, reports) # Closing logs the failed reconcile rather than raising
+    assert (target.succeeded, target.failed) == (4, 1)
+    assert id_database_filepath.with_suffix(".journal").stat().st_size > 0
+
+    reddit.search_fails = False
+    resume(reddit, id_database_filepath, reports)
+    assert_posted_once(reddit, id_database_filepath, reports)
+
+@pytest.mark.parametrize("torn_tail", ["\0\0\0\0", 'intent,20220401E9,"[1 Fatal', "result,E"])
+def test_crash_leaves_torn_journal_tail(tmp_path, committed_sizes, torn_tail):
+    id_database_filepath = tmp_path / "id_database.csv"
+    reddit = FakeReddit({3: "crash after post"})
+    reports = make_reports(5)
+    target = NTSB_bot.Target("test", reddit, "sub", None, id_database_filepath, 0)
+    with pytest.raises(Crash):
+        target.submit_batch(reports)
+    crash(target, committed_sizes)
+    with open(id_database_filepath.with_suffix(".journal"), "a", newline='') as fp:
+        fp.write(torn_tail)
+
+    resume(reddit, id_database_filepath, reports)
+    assert_posted_once(reddit, id_database_filepath, reports)
+
+def test_dry_run_leaves_files_alone(tmp_path, monkeypatch):
+    monkeypatch.setattr(NTSB_bot, "DRY_RUN", True)
+    id_database_filepath = tmp_path / "id_database.csv"
+    id_database_filepath.write_text("E9\n")
+    journal_filepath = id_database_filepath.with_suffix(".journal")
+    journal_filepath.write_text("result,E8,p8\n")
+    reddit = FakeReddit()
+    target = resume(reddit, id_database_filepath, make_reports(5))
+    assert target.succeeded == 5
+    assert reddit.posts == []
+    assert id_database_filepath.read_text() == "E9\n"
+    assert journal_filepath.read_text() == "result,E8,p8\n"
+
+    resume(reddit, tmp_path / "new.csv", make_reports(5))
+    assert not (tmp_path / "new.journal").exists()
+
+def test_fan_out_to_targets(tmp_path, monkeypatch):
+    monkeypatch.setattr(NTSB_bot, "DRY_RUN", False)
+    events = {"a.mdb": ["E0", "E1"], "b.mdb": ["E1", "E2", "E3"]} # E1 is listed in both files
+    fatal_events = {"E0", "E2", "E3"}
+    rendered = []
+    def fake_parse_events(epoch, mdb_filepath, conditions, seen_ids):
+        yield len(events[mdb_filepath.name])
+        for event_id in events[mdb_filepath.name]:
+            report = mdb_reader.Report(f"20220401{event_id}", f"ERA22LA{event_id}")
+            report.targets = {name for name, condition in conditions.items() if condition is None or event_id in fatal_events}
+            if all(report.event_id in seen_ids[name] for name in report.targets):
+                yield None
+                continue
+            report.title = f"Event {event_id}"
+            report.text = f"NTSB Number **{report.ntsb_no}**"
+            rendered.append(event_id)
+            yield report
+    monkeypatch.setattr(mdb_reader, "parse_events", fake_parse_events)
+    (tmp_path / "fatal.csv").write_text("E3\n") # Already posted to the fatal target
+
+    reddit = FakeReddit()
+    targets = [
+        NTSB_bot.Target("all", reddit, "general", None, tmp_path / "all.csv", 0),
+        NTSB_bot.Target("fatal", reddit, "fatal_only", "events.inj_tot_f > 0", tmp_path / "fatal.csv", 0),
+    ]
+    NTSB_bot.submit_new_documents(targets, [tmp_path / "a.mdb", tmp_path / "b.mdb"])
+
+    posts = sorted((post.subreddit.display_name, post.title) for post in reddit.posts)
+    assert posts == [
+        ("fatal_only", "Event E0"), ("fatal_only", "Event E2"),
+        ("general", "Event E0"), ("general", "Event E1"), ("general", "Event E2"), ("general", "Event E3"),
+    ]
+    assert rendered == ["E0", "E1", "E2", "E3"] # Each report is rendered once
+    assert sorted(NTSB_bot.load_id_database(tmp_path / "all.csv")) == ["E0", "E1", "E2", "E3"]
+    assert sorted(NTSB_bot.load_id_database(tmp_path / "fatal.csv")) == ["E0", "E2", "E3"]
+
+def test_parse_events_skips_rendering_seen_events(monkeypatch):
+    queries = []
+    class FakeCursor:
+        def execute(self, query):
+            queries.append(query)
+        def fetchall(self):
+            event_ids = ["20220401E0", "20220401E1", "20220401E2"]
+            if "inj_tot_f" in queries[-1]:
+                event_ids = ["20220401E1"]
+            return [SimpleNamespace(ev_id=event_id, ntsb_no=None) for event_id in event_ids]
+    monkeypatch.setattr(mdb_reader.pyodbc, "connect", lambda connection_string: SimpleNamespace(cursor=FakeCursor))
+    rendered = []
+    monkeypatch.setattr(mdb_reader, "generate_title", lambda event_id: rendered.append(event_id) or "Title")
+    for table in ["generate_description", "aircraft_operator_info", "meteorological_info", "wreckage_and_impact_info", "generate_signature"]:
+        monkeypatch.setattr(mdb_reader, table, lambda event_id: '')
+
+    conditions = {"all": None, "fatal": "events.inj_tot_f > 0"}
+    seen_ids = {"all": {"E0", "E1"}, "fatal": set()}
+    doc_generator = mdb_reader.parse_events(date(2022, 4, 1), Path("a.mdb"), conditions, seen_ids)
+    assert next(doc_generator) == 3
+    reports = list(doc_generator)
+
+    assert reports[0] is None
+    assert (reports[1].event_id, reports[1].targets) == ("E1", {"all", "fatal"})
+    assert (reports[2].event_id, reports[2].targets) == ("E2", {"all"})
+    assert rendered == ["20220401E1", "20220401E2"]
+    assert len(queries) == 2 # The unfiltered target reuses the event query
+
+@pytest.mark.parametrize("account_info, expected", [
+    ("", [("default", "main", None, "id_database.csv", 0.0)]),
+    (
+        "[TARGET all]\nsubreddit name = general\n"
+        "[TARGET fatal]\nsubreddit name = fatal_only\nfilter = events.inj_tot_f > 0\nid database = {tmp_path}/fatal.csv\nsubmit interval = 10\n",
+        [("all", "general", None, "id_database_all.csv", 0.0), ("fatal", "fatal_only", "events.inj_tot_f > 0", "fatal.csv", 10.0)],
+    ),
+])
+def test_get_targets(tmp_path, monkeypatch, account_info, expected):
+    account_info_filepath = tmp_path / "account.ini"
+    account_info_filepath.write_text(
+        "[ACCOUNT INFO]\nusername = bot\npassword = \nuser agent = \nclient id = \nclient secret = \nsubreddit name = main\n"
+        + account_info.format(tmp_path=tmp_path)
+    )
+    monkeypatch.setattr(NTSB_bot, "ACCOUNT_INFO_FILEPATH", account_info_filepath)
+    monkeypatch.setattr(NTSB_bot, "ID_DATABASE_FILEPATH", tmp_path / "id_database.csv")
+    monkeypatch.setattr(NTSB_bot.praw, "Reddit", lambda **kwargs: FakeReddit())
+
+    targets = NTSB_bot.get_targets()
+    for target in targets:
+        target.close()
+    assert [
+        (target.name, target.subreddit.display_name, target.condition, target.id_database_filepath.name, target.submit_interval)
+        for target in targets
+    ] == expected
+    assert len({id(target.reddit) for target in targets}) == len(targets) # One Reddit instance per target